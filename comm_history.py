@@ -3,37 +3,79 @@
 """Reads email and WhatsApp conversation export files and writes a HTML file."""
 
 import argparse
-import email
+import codecs
+import dataclasses
+import datetime
+import email.parser
 from email import policy
+import functools
+import heapq
 import html
 import dateutil.parser
 import itertools
 import jinja2
+from markupsafe import escape, Markup
+from operator import attrgetter
 import os.path
 import re
-from collections import namedtuple, defaultdict
 
 
 DEFAULT_CSS = "default.css"
 DUPLICATE_TOLERANCE = 60    # seconds
 
 # Format of the standard WhatsApp export line. This is likely to change in the
-# future and so this application will need to be updated.
-WA_TIME_RE = '(?P<time>[\d:]+( [AP]M)?)'
-WA_MESSAGE_RE = ('(?P<date>[.\d/-]+)'
-               ',? ' +
-               WA_TIME_RE +
-               '( -|:) '
-               '(?P<name>[^:]+)'
-               ': '
-               '(?P<body>.*$)')
-
-WA_FIRSTLINE_RE = ('(?P<date>[.\d/-]+)'
-               ',? ' +
-               WA_TIME_RE +
-               '( -|:) '
-               '(?P<body>.*$)')
-
+# future and so this application will need to be updated. The name is missing
+# in the first line. Every following line that doesn't start like a message
+# line is a continuation of the message.
+WA_DATE_RE = r'[.\d/-]+'
+WA_TIME_RE = r'[\d:]+(?: [AP]M)?'
+WA_SEP_RE = r'(?: -|:) '
+# The start of a message line, as a format string taking the date and time
+# patterns, so that matching a message and recognizing the start of the next
+# one can't disagree.
+WA_LINE_START_FORMAT = '{date},? {time}' + WA_SEP_RE
+WA_LINE_START_RE = WA_LINE_START_FORMAT.format(date=WA_DATE_RE,
+                                               time=WA_TIME_RE)
+WA_MULTILINE_RE = ('^' +
+                   WA_LINE_START_FORMAT.format(
+                       date='(?P<date>' + WA_DATE_RE + ')',
+                       time='(?P<time>' + WA_TIME_RE + ')') +
+                   r'(?:(?P<name>[^:\n]+): )?'
+                   r'(?P<body>.*)'
+                   r'(?P<continuation>(?:\n(?!' + WA_LINE_START_RE + r')(?!\Z).*)*)')
+
+WA_MULTILINE_PATTERN = re.compile(WA_MULTILINE_RE, re.MULTILINE)
+
+# An email export starts with an mbox "From " line or a header field, and its
+# header contains a From field. Only the start of the text is inspected.
+EMAIL_SNIFF_SIZE = 8192     # bytes
+EMAIL_FIRSTLINE_PATTERN = re.compile(r'From |[\x21-\x39\x3b-\x7e]+:')
+EMAIL_FROM_PATTERN = re.compile('^From:', re.MULTILINE | re.IGNORECASE)
+
+# Date and time formats commonly found in WhatsApp exports. These are tried
+# with strptime() first, as dateutil's generic parser is much slower. Only
+# day first formats are listed, for which strptime() and dateutil with
+# dayfirst=True agree; two digit years are expanded like dateutil does, see
+# ExpandTwoDigitYear(). Anything else, including ISO dates, which dateutil
+# reads with day and month swapped, is left to dateutil.
+WA_DATETIME_FORMATS = [
+    "%d/%m/%y %H:%M",
+    "%d/%m/%y %H:%M:%S",
+    "%d/%m/%y %I:%M %p",
+    "%d/%m/%y %I:%M:%S %p",
+    "%d/%m/%Y %H:%M",
+    "%d/%m/%Y %H:%M:%S",
+    "%d-%m-%y %H:%M",
+    "%d-%m-%y %H:%M:%S",
+    "%d-%m-%y %I:%M %p",
+    "%d-%m-%y %I:%M:%S %p",
+    "%d.%m.%y %H:%M",
+    "%d.%m.%y %H:%M:%S",
+    "%d.%m.%y %I:%M %p",
+    "%d.%m.%y %I:%M:%S %p",
+    "%d.%m.%Y %H:%M",
+    "%d.%m.%Y %H:%M:%S",
+]
 
 
 class Error(Exception):
@@ -41,83 +83,102 @@ class Error(Exception):
     pass
 
 
-class Users:
-    def __init__(self):
-        self.users = {}
-        self.id_gen = itertools.count(1)
-    
-    def id(self, name):
-        if name and name not in self.users:
-            self.users[name] = next(self.id_gen)
-        
-        return self.users.get(name, '')
-
-
-users = Users()
-Message = namedtuple('Message', 'date user body id type')
+@dataclasses.dataclass(frozen=True, slots=True)
+class Message:
+    date: datetime.datetime
+    user: str
+    body: str
+    id: int | str | None
+    type: str
 
 
-def ParseWALine(line):
-    """Parses a single line of WhatsApp export file."""
-    
-    # Try normal chat message
-    m = re.match(WA_MESSAGE_RE, line)
-    if m:
-        d = dateutil.parser.parse("%s %s" % (m.group('date'),
-            m.group('time')), dayfirst=True)
-        return d, m.group('name'), m.group('body')
+def ExpandTwoDigitYear(year):
+    """Expands a two digit year to within 50 years of today, as dateutil does,
+    where strptime() would use the fixed 1969-2068 window.
+    """
+    this_year = datetime.date.today().year
+    year += this_year // 100 * 100
+    if year >= this_year + 50:
+        year -= 100
+    elif year < this_year - 50:
+        year += 100
     
-    # Maybe it's the first line which doesn't contain a person's name.
-    m = re.match(WA_FIRSTLINE_RE, line)
-    if m:
-        d = dateutil.parser.parse("%s %s" % (m.group('date'),
-            m.group('time')), dayfirst=True)
-        return d, "", m.group('body')
+    return year
+
+
+# Messages sent within the same minute share their timestamp text, so parsed
+# timestamps are cached.
+@functools.lru_cache(maxsize=16384)
+def ParseWATimestamp(text):
+    """Parses the "<date> <time>" prefix of a WhatsApp export line."""
+    for fmt in WA_DATETIME_FORMATS:
+        try:
+            d = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if '%y' in fmt:
+            d = d.replace(year=ExpandTwoDigitYear(d.year % 100))
+        return d
     
-    return None
+    return dateutil.parser.parse(text, dayfirst=True)
 
 
-def IdentifyWAMessages(lines):
+def IdentifyWAMessages(text):
     """Input text can contain multi-line messages. If there's a line that
     doesn't start with a date and a name, that's probably a continuation of the
     previous message and should be appended to it.
     """
     messages = []
     
-    def append_message(msg_date, msg_user, msg_body):
-        msg = Message(msg_date, msg_user, msg_body, users.id(msg_user), 'whatsapp')
+    for m in WA_MULTILINE_PATTERN.finditer(text):
+        if not messages and m.start() != 0:
+            break
+        
+        msg_date = ParseWATimestamp("%s %s" % (m.group('date'),
+            m.group('time')))
+        msg_user = m.group('name') or ""
+        msg_body = m.group('body')
+        continuation = m.group('continuation')
+        if continuation:
+            msg_body = '\n'.join([msg_body] + [line.strip() for line in
+                                               continuation[1:].split('\n')])
+        
+        msg = Message(msg_date, msg_user, msg_body, None, 'whatsapp')
         messages.append(msg)
-
     
-    msg_date = None
-    msg_user = None
-    msg_body = None
+    if text and not messages:
+        line = text.splitlines(True)[0]
+        raise Error("Can't parse the first line: " + repr(line) +
+                ', regex is ' + repr(WA_MULTILINE_RE))
     
-    for line in lines:
-        m = ParseWALine(line)
-        if m is not None:
-            if msg_date is not None:
-                # We have a new message, so there will be no more lines for the
-                # one we've seen previously -- it's complete. Let's add it to
-                # the list.
-                append_message(msg_date, msg_user, msg_body)
-            msg_date, msg_user, msg_body = m
-        else:
-            if msg_date is None:
-                raise Error("Can't parse the first line: " + repr(line) +
-                        ', regexes are ' + repr(WA_FIRSTLINE_RE) + 
-                        ' and ' + repr(WA_MESSAGE_RE))
-            msg_body += '\n' + line.strip()
+    return messages
+
+
+email_parser = email.parser.BytesParser(policy=policy.default)
+
+
+def LooksLikeEmail(text):
+    """Cheap check whether the text can be an email, so that other exports
+    don't have to go through the email parser.
+    """
+    head = text[:EMAIL_SNIFF_SIZE]
+    if not EMAIL_FIRSTLINE_PATTERN.match(head):
+        return False
     
-    # The last message remains. Let's add it, if it exists.
-    if msg_date is not None:
-        append_message(msg_date, msg_user, msg_body)
+    # If the header doesn't end within the sniffed part, let the parser decide.
+    end = head.find('\n\n')
+    if end == -1:
+        return True
     
-    return messages
+    return EMAIL_FROM_PATTERN.search(head, 0, end) is not None
 
 
-def IdentifyEmailMessage(text):
-    m = email.message_from_string(text, policy=policy.default)
+def IdentifyEmailMessage(raw):
+    head = raw[:EMAIL_SNIFF_SIZE].decode('utf-8', errors='replace')
+    if not LooksLikeEmail(head):
+        return None
+    
+    m = email_parser.parsebytes(raw)
     
     if 'From' in m:
         
@@ -133,45 +194,91 @@ def IdentifyEmailMessage(text):
 
         msg_date = dateutil.parser.parse(m.get('Date'), ignoretz=True)
         msg_user = html.escape(m.get('From'))
-        msg_body = jinja2.Markup(
-            m.get_body(preferencelist=('plain', 'html')).get_content())
+        msg_body = Markup(NormalizeLineEndings(
+            m.get_body(preferencelist=('plain', 'html')).get_content()))
         
-        return Message(msg_date, msg_user, msg_body, users.id(msg_user), 'email')
+        return Message(msg_date, msg_user, msg_body, None, 'email')
     
     return None
 
 
-def IdentifyMessages(text):
-    message = IdentifyEmailMessage(text)
+def IdentifyMessages(raw):
+    """Identifies the messages in the raw contents of an export file, see
+    ReadFile().
+    """
+    message = IdentifyEmailMessage(raw)
     if message is not None:
         return [ message ]
         
-    return IdentifyWAMessages(text.splitlines(True))
+    return IdentifyWAMessages(DecodeText(raw))
 
 
-def ProcessInputFiles(input_files):
-    messages = []
-    indexes = defaultdict(list)
+def NormalizeLineEndings(text):
+    """Returns the text with all line endings as '\\n'."""
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
     
-    def is_duplicate(msg):
-        for i in indexes[(msg.user, msg.body)]:
-            delta = msg.date - messages[i].date 
-            if abs(delta.total_seconds()) <= DUPLICATE_TOLERANCE:
-               return True
-        
-        return False
+    return text
+
+
+def DecodeText(raw):
+    """Decodes UTF-8 file contents and normalizes the line endings."""
+    return NormalizeLineEndings(raw.decode('utf-8'))
+
+
+def ReadFile(path):
+    """Reads a whole file, without a UTF-8 byte order mark."""
+    with open(path, 'rb') as fd:
+        raw = fd.read()
     
-    def append_message(msg):
-        if not is_duplicate(msg):
-            messages.append(msg)
-            indexes[(msg.user, msg.body)].append(len(messages) - 1)
+    if raw.startswith(codecs.BOM_UTF8):
+        raw = raw[len(codecs.BOM_UTF8):]
     
+    return raw
+
+
+def ReadTextFile(path):
+    """Reads a whole UTF-8 text file, see DecodeText()."""
+    return DecodeText(ReadFile(path))
+
+
+def ProcessInputFiles(input_files):
+    by_file = []
     for input_file in input_files:
-        with open(input_file, 'rt', encoding='utf-8-sig') as fd:
-            for msg in IdentifyMessages(fd.read()):
-                append_message(msg)
+        by_file.append(IdentifyMessages(ReadFile(input_file)))
+    
+    return MergeMessages(by_file)
+
+
+def MergeMessages(by_file):
+    """Merges the messages of several input files in time order, drops the
+    duplicates and numbers the users in order of their first message.
+    Messages without a user get an empty id.
+    Returns:
+        A list of messages with the id set.
+    """
+    messages = []
+    # Date of the last message kept, by user and body. The messages of all
+    # files are merged in time order, so a duplicate can only be close after
+    # the last kept message with the same user and body.
+    last_dates = {}
+    user_ids = {'': ''}
+    id_gen = itertools.count(1)
     
-    messages.sort(key=lambda m: m.date)
+    sorted_by_file = [sorted(msgs, key=attrgetter('date')) for msgs in by_file]
+    for msg in heapq.merge(*sorted_by_file, key=attrgetter('date')):
+        key = (msg.user, msg.body)
+        last_date = last_dates.get(key)
+        if last_date is not None:
+            delta = msg.date - last_date
+            if delta.total_seconds() <= DUPLICATE_TOLERANCE:
+                continue
+        last_dates[key] = msg.date
+        
+        user_id = user_ids.get(msg.user)
+        if user_id is None:
+            user_id = user_ids[msg.user] = next(id_gen)
+        messages.append(Message(msg.date, msg.user, msg.body, user_id, msg.type))
             
     return messages
 
@@ -179,31 +286,37 @@ def ProcessInputFiles(input_files):
 def TemplateData(messages, input_filenames, collate=True):
     """Create a struct suitable for procesing in a template.
     Returns:
-        A dictionary of values.
+        A dictionary of values. by_user holds a list of (message, escaped
+        lines) pairs per user.
     """
     by_user = []
     file_basenames = [os.path.splitext(os.path.basename(f))[0]
                       for f in input_filenames]
     
+    # Each message goes with the HTML escaped lines of its body, so that the
+    # template doesn't have to split and escape them.
     if collate:
-        for user, msgs_of_user in itertools.groupby(messages, lambda m: m.user):
-            by_user.append((user, list(msgs_of_user)))
-    else:
+        user = msgs_of_user = None
         for msg in messages:
-            by_user.append((msg.user, [msg]))
+            if msgs_of_user is None or msg.user != user:
+                user, msgs_of_user = msg.user, []
+                by_user.append((user, msgs_of_user))
+            msgs_of_user.append((msg, str(escape(msg.body)).split('\n')))
+    else:
+        by_user = [(msg.user, [(msg, str(escape(msg.body)).split('\n'))])
+                   for msg in messages]
     
     return dict(by_user=by_user, input_basenames=file_basenames,
                 input_full_paths=input_filenames)
 
 
-def FormatHTML(data, css):    
-    tmpl = """<!DOCTYPE html>
+TEMPLATE = """<!DOCTYPE html>
     <html>
     <head>
         <title>{{ ", ".join(input_basenames) }}</title>
         <meta charset="utf-8"/>
         <meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>""" + css + """</style>
+        <style>{{ css | safe }}</style>
     </head>
     <body>
         {% for input_file in input_basenames %}
@@ -213,12 +326,12 @@ def FormatHTML(data, css):
         {% for user, messages in by_user %}
             <div class="bubble">
                 <div class="txt">
-                    <p class="name"><span class="user{{ messages[0].id }}">{{ user }}</span></p>
-                    {% for message in messages %}
+                    <p class="name"><span class="user{{ messages[0][0].id }}">{{ user }}</span></p>
+                    {% for message, lines in messages %}
                     <div class="message">
                         <p>
-                        {% for line in message.body.split("\n") %}
-                            {{ line | e }}<br>
+                        {% for line in lines %}
+                            {{ line }}<br>
                         {% endfor %}
                             <span class="timestamp">{{ message.date }}</span>
                         </p>
@@ -232,8 +345,13 @@ def FormatHTML(data, css):
     </body>
     </html>
     """
-    
-    return jinja2.Environment().from_string(tmpl).render(**data)
+
+html_template = jinja2.Environment(
+    trim_blocks=True, lstrip_blocks=True).from_string(TEMPLATE)
+
+
+def FormatHTML(data, css):
+    return html_template.render(css=css, **data)
 
 
 def ParseArguments():   
@@ -258,8 +376,7 @@ def main():
     
     messages = ProcessInputFiles(args.input_file)
     template_data = TemplateData(messages, args.input_file, args.collate)
-    with open(args.style_file, 'rt', encoding='utf-8-sig') as fd:
-        css = fd.read()
+    css = ReadTextFile(args.style_file)
     html = FormatHTML(template_data, css)
     with open(args.output_file, 'w', encoding='utf-8') as fd:
         fd.write(html)
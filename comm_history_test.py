@@ -2,83 +2,102 @@
 
 import unittest
 import datetime
+import os.path
+import tempfile
+import dateutil.parser
 import comm_history
 
-INPUT_1 = ["13/01/18, 01:23 - Fake Name: line1\n", "line2\n"]
-INPUT_2 = ["13/01/18, 01:23 - Fake Name: line1\n", "line2\n",
-        "13/01/18, 01:24 - Name Two: single line\n"]
-INPUT_3 = ["13/01/18, 01:23 - Fake Name: line1\n", "line2\n",
-        "13/01/18, 01:24 - Fake Name: line3\n",
-        "13/01/18, 01:25 - Name Two: single line\n"]
-INPUT_4 = ["14/04/18, 22:08 - Nesta conversa, (…)\n",
-           "14/04/18, 22:08 - Alguém: Olá!\n"]
+INPUT_1 = ("13/01/18, 01:23 - Fake Name: line1\n"
+           "line2\n")
+INPUT_2 = ("13/01/18, 01:23 - Fake Name: line1\n"
+           "line2\n"
+           "13/01/18, 01:24 - Name Two: single line\n")
+INPUT_3 = ("13/01/18, 01:23 - Fake Name: line1\n"
+           "line2\n"
+           "13/01/18, 01:24 - Fake Name: line3\n"
+           "13/01/18, 01:25 - Name Two: single line\n")
+INPUT_4 = ("14/04/18, 22:08 - Nesta conversa, (…)\n"
+           "14/04/18, 22:08 - Alguém: Olá!\n")
 # Format from a different locale setting.
-INPUT_5 = ["19-02-18 17:02 - Los mensajes y llamadas en este chat ahora están "
+INPUT_5 = ("19-02-18 17:02 - Los mensajes y llamadas en este chat ahora están "
            "protegidos con cifrado de extremo a extremo. Toca para más "
-           "información.\n",
-           "19-02-18 17:02 - human1: Hola\n",
-           "19.02.18 17:14 - human2: como estás?\n"]
+           "información.\n"
+           "19-02-18 17:02 - human1: Hola\n"
+           "19.02.18 17:14 - human2: como estás?\n")
 # Based on https://github.com/automatthias/whatsapp-archive/issues/1
 # 12-hour format.
-INPUT_6 = ["2016-06-27, 8:04:08 AM: Neil: Hi\n",]
+INPUT_6 = "2016-06-27, 8:04:08 AM: Neil: Hi\n"
+# Indented and empty continuation lines, and no final newline.
+INPUT_7 = ("13/01/18, 01:23 - Fake Name: line1\n"
+           "   line2  \n"
+           "\n"
+           "line3")
 
 class IdentifyWAMessagesTest(unittest.TestCase):
 
     def test1_InputMultiline(self):
         self.assertEqual(comm_history.IdentifyWAMessages(INPUT_1), [
-            (datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', 1, 'whatsapp'),
+            comm_history.Message(datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', None, 'whatsapp'),
         ])
 
     def test2_InputTwoMultiline(self):
         self.assertEqual(comm_history.IdentifyWAMessages(INPUT_2), [
-            (datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', 1, 'whatsapp'),
-            (datetime.datetime(2018, 1, 13, 1, 24), 'Name Two', 'single line', 2, 'whatsapp'),
+            comm_history.Message(datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', None, 'whatsapp'),
+            comm_history.Message(datetime.datetime(2018, 1, 13, 1, 24), 'Name Two', 'single line', None, 'whatsapp'),
         ])
 
     def test3_TemplateData(self):
-        messages = comm_history.IdentifyWAMessages(INPUT_3)
+        messages = comm_history.MergeMessages([comm_history.IdentifyWAMessages(INPUT_3)])
         template_data = comm_history.TemplateData(messages, ["fake_filename"])
         self.assertEqual(template_data, {
             'by_user': [
                 ('Fake Name', [
-                    (datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', 1, 'whatsapp'),
-                    (datetime.datetime(2018, 1, 13, 1, 24), 'Fake Name', 'line3', 1, 'whatsapp')
+                    (comm_history.Message(datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', 1, 'whatsapp'),
+                        ['line1', 'line2']),
+                    (comm_history.Message(datetime.datetime(2018, 1, 13, 1, 24), 'Fake Name', 'line3', 1, 'whatsapp'),
+                        ['line3'])
                 ]),
                 ('Name Two', [
-                    (datetime.datetime(2018, 1, 13, 1, 25), 'Name Two', 'single line', 2, 'whatsapp')
+                    (comm_history.Message(datetime.datetime(2018, 1, 13, 1, 25), 'Name Two', 'single line', 2, 'whatsapp'),
+                        ['single line'])
                 ])
             ],
             'input_basenames': ['fake_filename'],
             'input_full_paths': ['fake_filename']})
 
     def testTemplateDataNoCollate(self):
-        messages = comm_history.IdentifyWAMessages(INPUT_3)
+        messages = comm_history.MergeMessages([comm_history.IdentifyWAMessages(INPUT_3)])
         template_data = comm_history.TemplateData(messages, ["fake_filename"], False)
         self.assertEqual(template_data, {
             'by_user': [
                 ('Fake Name', [
-                    (datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', 1, 'whatsapp')
+                    (comm_history.Message(datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', 1, 'whatsapp'),
+                        ['line1', 'line2'])
                 ]),
                 ('Fake Name', [
-                    (datetime.datetime(2018, 1, 13, 1, 24), 'Fake Name', 'line3', 1, 'whatsapp')
+                    (comm_history.Message(datetime.datetime(2018, 1, 13, 1, 24), 'Fake Name', 'line3', 1, 'whatsapp'),
+                        ['line3'])
                 ]),
                 ('Name Two', [
-                    (datetime.datetime(2018, 1, 13, 1, 25), 'Name Two', 'single line', 2, 'whatsapp')
+                    (comm_history.Message(datetime.datetime(2018, 1, 13, 1, 25), 'Name Two', 'single line', 2, 'whatsapp'),
+                        ['single line'])
                 ])
             ],
             'input_basenames': ['fake_filename'],
             'input_full_paths': ['fake_filename']})
 
     def test4_FirstLineNoColon(self):
-        messages = comm_history.IdentifyWAMessages(INPUT_4)
+        messages = comm_history.MergeMessages([comm_history.IdentifyWAMessages(INPUT_4)])
         template_data = comm_history.TemplateData(messages, ["fake_filename"])
         self.assertEqual(template_data, {
             'by_user': [
                 ('', [
-                    (datetime.datetime(2018, 4, 14, 22, 8), '', 'Nesta conversa, (…)', '', 'whatsapp'),
+                    (comm_history.Message(datetime.datetime(2018, 4, 14, 22, 8), '', 'Nesta conversa, (…)', '', 'whatsapp'),
+                        ['Nesta conversa, (…)']),
                 ]),
                 ('Alguém', [
-                    (datetime.datetime(2018, 4, 14, 22, 8), 'Alguém', 'Olá!', 3, 'whatsapp'),
+                    (comm_history.Message(datetime.datetime(2018, 4, 14, 22, 8), 'Alguém', 'Olá!', 1, 'whatsapp'),
+                        ['Olá!']),
                 ]),
               ],
               'input_basenames': ['fake_filename'],
@@ -86,21 +105,26 @@ class IdentifyWAMessagesTest(unittest.TestCase):
 
     def test5_DifferentFormat(self):
         self.maxDiff = None
-        messages = comm_history.IdentifyWAMessages(INPUT_5)
+        messages = comm_history.MergeMessages([comm_history.IdentifyWAMessages(INPUT_5)])
         template_data = comm_history.TemplateData(messages, ["fake_filename"])
         self.assertEqual(template_data, {
             'by_user': [
                 ('', [
-                    (datetime.datetime(2018, 2, 19, 17, 2),
+                    (comm_history.Message(datetime.datetime(2018, 2, 19, 17, 2),
                         '', 'Los mensajes y llamadas en este chat ahora '
                         'están protegidos con cifrado de extremo a extremo. '
                         'Toca para más información.', '', 'whatsapp'),
+                        ['Los mensajes y llamadas en este chat ahora '
+                         'están protegidos con cifrado de extremo a extremo. '
+                         'Toca para más información.']),
                 ]),
                 ('human1', [
-                    (datetime.datetime(2018, 2, 19, 17, 2), 'human1', 'Hola', 4, 'whatsapp'),
+                    (comm_history.Message(datetime.datetime(2018, 2, 19, 17, 2), 'human1', 'Hola', 1, 'whatsapp'),
+                        ['Hola']),
                 ]),
                 ('human2', [
-                    (datetime.datetime(2018, 2, 19, 17, 14), 'human2', 'como estás?', 5, 'whatsapp'),
+                    (comm_history.Message(datetime.datetime(2018, 2, 19, 17, 14), 'human2', 'como estás?', 2, 'whatsapp'),
+                        ['como estás?']),
                 ]),
               ],
               'input_basenames': ['fake_filename'],
@@ -108,18 +132,144 @@ class IdentifyWAMessagesTest(unittest.TestCase):
 
     def test6_Neil(self):
         self.maxDiff = None
-        messages = comm_history.IdentifyWAMessages(INPUT_6)
+        messages = comm_history.MergeMessages([comm_history.IdentifyWAMessages(INPUT_6)])
         template_data = comm_history.TemplateData(messages, ["fake_filename"])
         self.assertEqual(template_data, {
             'by_user': [
                 ('Neil', [
-                    (datetime.datetime(2016, 6, 27, 8, 4, 8),
-                        'Neil', 'Hi', 6, 'whatsapp'),
+                    (comm_history.Message(datetime.datetime(2016, 6, 27, 8, 4, 8),
+                        'Neil', 'Hi', 1, 'whatsapp'),
+                        ['Hi']),
                 ]),
               ],
               'input_basenames': ['fake_filename'],
               'input_full_paths': ['fake_filename']})
 
+    def test7_ContinuationLines(self):
+        messages = comm_history.IdentifyWAMessages(INPUT_7)
+        self.assertEqual([m.body for m in messages], ['line1\nline2\n\nline3'])
+
+    def testFormatHTMLLines(self):
+        messages = comm_history.MergeMessages([comm_history.IdentifyWAMessages(
+            INPUT_1 + "13/01/18, 01:25 - Name Two: <b>&</b>\n")])
+        template_data = comm_history.TemplateData(messages, ["fake_filename"])
+        html = comm_history.FormatHTML(template_data, "")
+        self.assertIn("line1<br>", html)
+        self.assertIn("line2<br>", html)
+        self.assertIn("&lt;b&gt;&amp;&lt;/b&gt;<br>", html)
+
+    def testUnparsableFirstLine(self):
+        with self.assertRaises(comm_history.Error):
+            comm_history.IdentifyWAMessages("no date\n" + INPUT_1)
+
+
+class ParseWATimestampTest(unittest.TestCase):
+
+    def testFastFormats(self):
+        self.assertEqual(comm_history.ParseWATimestamp('13/01/18 01:23'),
+                         datetime.datetime(2018, 1, 13, 1, 23))
+        self.assertEqual(comm_history.ParseWATimestamp('19.02.18 17:14'),
+                         datetime.datetime(2018, 2, 19, 17, 14))
+        self.assertEqual(comm_history.ParseWATimestamp('2016-06-27 8:04:08 PM'),
+                         datetime.datetime(2016, 6, 27, 20, 4, 8))
+
+    def testAgreesWithDateutil(self):
+        # The strptime() fast path must never change what dateutil would give.
+        for date in ('07/06/%02d', '07-06-%02d', '07.06.%02d', '07/06/20%02d',
+                     '20%02d-06-07'):
+            for time in ('08:04', '08:04:08', '8:04 PM', '8:04:08 PM'):
+                for year in range(0, 100, 3):
+                    text = '%s %s' % (date % year, time)
+                    self.assertEqual(comm_history.ParseWATimestamp(text),
+                        dateutil.parser.parse(text, dayfirst=True), text)
+
+    def testSecondsDontChangeTheDay(self):
+        for without, with_seconds in (('2016-06-07 08:04', '2016-06-07 08:04:08'),
+                                      ('2016-06-07 8:04 AM', '2016-06-07 8:04:08 AM'),
+                                      ('07/06/16 08:04', '07/06/16 08:04:08'),
+                                      ('01/01/70 13:00', '01/01/70 1:00:00 PM'),
+                                      ('01-01-70 1:00 PM', '01-01-70 13:00:00')):
+            self.assertEqual(comm_history.ParseWATimestamp(without).date(),
+                             comm_history.ParseWATimestamp(with_seconds).date(),
+                             (without, with_seconds))
+
+    def testFallback(self):
+        # Month first, which none of the strptime() formats accept.
+        self.assertEqual(comm_history.ParseWATimestamp('12/31/18 1:02 PM'),
+                         datetime.datetime(2018, 12, 31, 13, 2))
+
+
+class LooksLikeEmailTest(unittest.TestCase):
+
+    def testEmail(self):
+        self.assertTrue(comm_history.LooksLikeEmail(
+            "Return-Path: <a@example.com>\n"
+            "from: A <a@example.com>\n"
+            "Date: Sat, 13 Jan 2018 01:23:00 +0100\n"
+            "\n"
+            "Hello\n"))
+        self.assertTrue(comm_history.LooksLikeEmail(
+            "From a@example.com Sat Jan 13 01:23:00 2018\n"))
+
+    def testNoEmail(self):
+        for text in (INPUT_1, INPUT_4, INPUT_5, INPUT_6, ""):
+            self.assertFalse(comm_history.LooksLikeEmail(text), text)
+        self.assertFalse(comm_history.LooksLikeEmail(
+            "Subject: no sender\n\nFrom: in the body\n"))
+
+
+class ProcessInputFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, lines):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w', encoding='utf-8') as fd:
+            fd.writelines(lines)
+        return path
+
+    def testByteOrderMarkAndLineEndings(self):
+        path = os.path.join(self.tmpdir.name, 'crlf.txt')
+        with open(path, 'wb') as fd:
+            fd.write(b'\xef\xbb\xbf' + INPUT_1.replace('\n', '\r\n').encode('utf-8'))
+        messages = comm_history.ProcessInputFiles([path])
+        self.assertEqual([m.body for m in messages], ['line1\nline2'])
+
+    def testEmailAndWhatsApp(self):
+        path = os.path.join(self.tmpdir.name, 'mail.eml')
+        with open(path, 'wb') as fd:
+            fd.write(b'\xef\xbb\xbf'
+                     b'From: Ann <ann@example.com>\r\n'
+                     b'Date: Sat, 13 Jan 2018 01:25:00 +0100\r\n'
+                     b'Content-Type: text/plain; charset=utf-8\r\n'
+                     b'Content-Transfer-Encoding: 8bit\r\n'
+                     b'\r\n'
+                     b'Hallo W\xc3\xb6rld\r\n'
+                     b'Zweite Zeile\r\n')
+        messages = comm_history.ProcessInputFiles(
+            [path, self.write('chat.txt', [INPUT_2])])
+        self.assertEqual(messages, [
+            comm_history.Message(datetime.datetime(2018, 1, 13, 1, 23), 'Fake Name', 'line1\nline2', 1, 'whatsapp'),
+            comm_history.Message(datetime.datetime(2018, 1, 13, 1, 24), 'Name Two', 'single line', 2, 'whatsapp'),
+            comm_history.Message(datetime.datetime(2018, 1, 13, 1, 25),
+                'Ann &lt;ann@example.com&gt;', 'Hallo Wörld\nZweite Zeile\n', 3, 'email'),
+        ])
+
+    def testDuplicatesAcrossFiles(self):
+        first = self.write('first.txt', [
+            "13/01/18, 01:23 - Fake Name: hello\n",
+            "13/01/18, 01:30 - Fake Name: hello\n"])
+        second = self.write('second.txt', [
+            "13/01/18, 01:24 - Fake Name: hello\n",
+            "13/01/18, 01:26 - Fake Name: hello\n",
+            "13/01/18, 01:27 - Name Two: hello\n"])
+        messages = comm_history.ProcessInputFiles([first, second])
+        self.assertEqual([(m.date.minute, m.user) for m in messages], [
+            (23, 'Fake Name'), (26, 'Fake Name'), (27, 'Name Two'),
+            (30, 'Fake Name')])
+
 
 if __name__ == '__main__':
     unittest.main()